@@ -1,39 +1,90 @@
 """I/O classes and helpers for APK files."""
 
-import glob
-import gzip
+import errno
+import grp
 import hashlib
 import io
 import logging
 import os
+import pwd
+import re
 import shutil
+import stat
 import sys
 import tarfile
 import yaml
 
+from contextlib import ExitStack
 from copy import deepcopy
-from fnmatch import fnmatch
-from functools import partial
+from fnmatch import translate
+from functools import lru_cache
 from itertools import chain
 from pathlib import Path
 from subprocess import Popen, PIPE
-from tempfile import mkstemp
+from tempfile import SpooledTemporaryFile
+from threading import Thread
 
 from apkkit.base.package import Package
-from apkkit.io.util import recursive_size
+from apkkit.io.util import scandir
 
 LOGGER = logging.getLogger(__name__)
 
 
+try:
+    # isa-l's gzip is several times faster than zlib's, where available.
+    from isal import igzip as _gzip_mod, isal_zlib
+except ImportError:
+    import gzip as _gzip_mod
+    isal_zlib = None  # pylint: disable=invalid-name
+
+
+_COPY_BUFSIZE = 256 * 1024
+"""Buffer size used when copying package streams between files."""
+
+
+_CHECKSUM_HEADER = 'APK-TOOLS.checksum.SHA1'
+"""The PAX header apk reads each file's checksum from."""
+
+
+_HASH_BUFSIZE = 1024 * 1024
+"""Chunk size used when feeding a stream to a hash, small enough to stay in
+cache."""
+
+
+_KEY_CACHE = {}
+"""Parsed private keys, mapping path to (mtime, key)."""
+
+
+_SENDFILE_UNSUPPORTED = frozenset((errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                                   errno.EXDEV))
+"""Errors from os.sendfile meaning it can't be used for this pair of files."""
+
+
+_SPOOL_SIZE = 8 * 1024 * 1024
+"""Size at which intermediate package buffers spill from memory to disk."""
+
+
+_DATA_SPOOL_SIZE = 32 * 1024 * 1024
+"""Size at which the compressed data.tar.gz spills from memory to disk."""
+
+
 try:
     # we need LOGGER.  pylint: disable=wrong-import-order,wrong-import-position
     from cryptography.hazmat.backends import default_backend
     from cryptography.hazmat.primitives import hashes, serialization
-    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.asymmetric import (
+        ec, ed25519, padding, utils
+    )
 except ImportError:
     LOGGER.warning("cryptography module is unavailable - can't sign packages.")
 
 
+# hashlib only uses OpenSSL's SHA implementation (and with it, SHA-NI and
+# friends if OpenSSL was built with them) when Python was linked against it.
+if type(hashlib.sha256()).__module__ != '_hashlib':
+    LOGGER.debug('hashlib is not backed by OpenSSL; hashing will be slower.')
+
+
 def load_global_split():
     """Load global split package information from split-global.conf."""
 
@@ -93,6 +144,29 @@ def path_components(path):
     return components
 
 
+def _path_matcher(paths):
+    """Build a predicate for names under, or matching the glob of, any path.
+
+    All prefixes are checked in one str.startswith call, and all globs are
+    translated into a single compiled regular expression, so the cost per
+    name doesn't grow with a Python-level loop over the paths.
+
+    :param paths:
+        The path prefixes / fnmatch patterns to match against.
+
+    :returns:
+        A function taking a name and returning True if it matches.
+    """
+
+    prefixes = tuple(paths)
+    if not prefixes:
+        return lambda name: False
+
+    pattern = re.compile('|'.join(translate(path) for path in prefixes))
+    return lambda name: name.startswith(prefixes) or\
+        pattern.match(name) is not None
+
+
 def split_filter(split_info, tar_info):
     """Determine if a file should be included in a split package.
 
@@ -103,17 +177,35 @@ def split_filter(split_info, tar_info):
         The TarInfo object to inspect.
     """
 
-    paths = set(split_info['paths'])
+    return _compile_split_filter(split_info)(tar_info)
+
+
+def _compile_split_filter(split_info):
+    """Build the split package filter for split_info.
+
+    The set of paths and their parent directories is computed once here,
+    rather than for every file in the package.
+
+    :param dict split_info:
+        The split parameters loaded from configuration.
+
+    :returns:
+        A function taking a TarInfo object, with the semantics of
+        :py:func:`split_filter`.
+    """
+
+    components = set(split_info['paths'])
     for path in split_info['paths']:
-        for component in path_components(path):
-            paths.add(component)
+        components.update(path_components(path))
+    matches = _path_matcher(split_info['paths'])
 
-    if any([tar_info.name.startswith(path) for path in split_info['paths']]) or\
-       any([tar_info.name == component for component in paths]) or\
-       any([fnmatch(tar_info.name, path) for path in split_info['paths']]):
-        return tar_info
+    def _filter(tar_info):
+        if tar_info.name in components or matches(tar_info.name):
+            return tar_info
+
+        return None
 
-    return None
+    return _filter
 
 
 def base_filter(exclude_from_base, tar_info):
@@ -126,29 +218,507 @@ def base_filter(exclude_from_base, tar_info):
         The TarInfo object to inspect.
     """
 
-    if any([tar_info.name.startswith(path) for path in exclude_from_base]) or\
-       any([fnmatch(tar_info.name, path) for path in exclude_from_base]):
+    return _compile_base_filter(exclude_from_base)(tar_info)
+
+
+def _compile_base_filter(exclude_from_base):
+    """Build the base package filter for exclude_from_base.
+
+    :param list exclude_from_base:
+        A list of paths to exclude from the base package.
+
+    :returns:
+        A function taking a TarInfo object, with the semantics of
+        :py:func:`base_filter`.
+    """
+
+    matches = _path_matcher(exclude_from_base)
+
+    def _filter(tar_info):
+        if matches(tar_info.name):
+            return None
+
+        return tar_info
+
+    return _filter
+
+
+@lru_cache(maxsize=None)
+def _uname(uid):
+    """Look up (and remember) the user name for a uid."""
+    try:
+        return pwd.getpwuid(uid)[0]
+    except KeyError:
+        return ''
+
+
+@lru_cache(maxsize=None)
+def _gname(gid):
+    """Look up (and remember) the group name for a gid."""
+    try:
+        return grp.getgrgid(gid)[0]
+    except KeyError:
+        return ''
+
+
+def _tarinfo_for(tar, entry, arcname):
+    """Build the TarInfo for a directory entry, as TarFile.gettarinfo would.
+
+    This uses the stat result cached on the entry and memoised owner names
+    instead of stat'ing and resolving every file again.
+
+    :param tar:
+        The TarFile the entry will be added to (used to track hard links).
+
+    :param entry:
+        The directory entry, as returned by scandir.
+
+    :param str arcname:
+        The name of the entry inside the archive.
+
+    :returns:
+        A TarInfo object, or None if the file type can't be archived.
+    """
+    statres = entry.stat(follow_symlinks=False)
+    stmd = statres.st_mode
+    tarinfo = tarfile.TarInfo(arcname)
+
+    if stat.S_ISREG(stmd):
+        inode = (statres.st_ino, statres.st_dev)
+        if statres.st_nlink > 1 and inode in tar.inodes and\
+           arcname != tar.inodes[inode]:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = tar.inodes[inode]
+        else:
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = statres.st_size
+            if inode[0]:
+                tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(stmd):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(stmd):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(entry.path)
+    elif stat.S_ISFIFO(stmd):
+        tarinfo.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(stmd):
+        tarinfo.type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(stmd):
+        tarinfo.type = tarfile.BLKTYPE
+    else:
         return None
 
-    return tar_info
+    tarinfo.mode = stmd
+    tarinfo.uid = statres.st_uid
+    tarinfo.gid = statres.st_gid
+    tarinfo.mtime = statres.st_mtime
+    tarinfo.uname = _uname(statres.st_uid)
+    tarinfo.gname = _gname(statres.st_gid)
+    if tarinfo.ischr() or tarinfo.isblk():
+        tarinfo.devmajor = os.major(statres.st_rdev)
+        tarinfo.devminor = os.minor(statres.st_rdev)
+    return tarinfo
 
-def _sign_control(control, privkey, pubkey):
-    """Sign control.tar.
 
-    :param control:
-        A file-like object representing the current control.tar.gz.
+def _checksum(fileobj):
+    """Calculate the APK checksum of a file's contents.
+
+    :param fileobj:
+        The file-like object to read from, at its start.
+
+    :returns str:
+        The hex SHA-1 digest of the contents.
+    """
+    hasher = hashlib.sha1()
+    buf = bytearray(_HASH_BUFSIZE)
+    view = memoryview(buf)
+    length = fileobj.readinto(buf)
+    while length:
+        hasher.update(view[:length])
+        length = fileobj.readinto(buf)
+    return hasher.hexdigest()
+
+
+def _add_tree(tar, path, arcname, my_filter):
+    """Recursively add the contents of a directory to a tar file.
+
+    Directories rejected by the filter are not descended into, exactly like
+    TarFile.add.  Regular files and symlinks get the per-file checksum header
+    apk uses to verify installed files, as abuild-tar --hash would add.
+
+    :param tar:
+        The TarFile to add to.
+
+    :param str path:
+        The directory whose contents should be added.
+
+    :param str arcname:
+        The name of the directory inside the archive, with a trailing slash,
+        or '' for the root of the archive.
+
+    :param callable my_filter:
+        A function taking a TarInfo object and returning it (possibly
+        modified), or None to exclude it.
+
+    :returns:
+        A tuple of the number of regular files added and their total size.
+    """
+    files = 0
+    size = 0
+    for entry in sorted(scandir(path), key=lambda entry: entry.name):
+        tarinfo = _tarinfo_for(tar, entry, arcname + entry.name)
+        if tarinfo is not None:
+            tarinfo = my_filter(tarinfo)
+        if tarinfo is None:
+            continue
+
+        if tarinfo.isreg():
+            with open(entry.path, 'rb') as fileobj:
+                if tarinfo.size <= _HASH_BUFSIZE:
+                    # read small files once, and archive them from memory.
+                    contents = fileobj.read(tarinfo.size)
+                    tarinfo.pax_headers[_CHECKSUM_HEADER] = hashlib.sha1(
+                        contents).hexdigest()
+                    tar.addfile(tarinfo, io.BytesIO(contents))
+                else:
+                    tarinfo.pax_headers[_CHECKSUM_HEADER] = _checksum(fileobj)
+                    fileobj.seek(0)
+                    tar.addfile(tarinfo, fileobj)
+            files += 1
+            size += tarinfo.size
+        elif tarinfo.issym():
+            tarinfo.pax_headers[_CHECKSUM_HEADER] = hashlib.sha1(
+                os.fsencode(tarinfo.linkname)).hexdigest()
+            tar.addfile(tarinfo)
+        else:
+            tar.addfile(tarinfo)
+            if tarinfo.isdir():
+                sub_files, sub_size = _add_tree(tar, entry.path,
+                                                tarinfo.name + '/', my_filter)
+                files += sub_files
+                size += sub_size
+
+    return files, size
+
+
+def _backing_file(fileobj):
+    """Find the file object that actually holds a file-like object's data.
+
+    SpooledTemporaryFile has no public way to get at what it is spooling to,
+    so this reaches into its private _file: a BytesIO until it rolls over to
+    disk (see its _rolled flag), and a real temporary file afterwards.  Asking
+    the SpooledTemporaryFile itself for fileno() would force it to roll over.
+
+    :param fileobj:
+        The file-like object to inspect.
+
+    :returns:
+        The underlying file object, or fileobj itself if it isn't spooled.
+    """
+    if isinstance(fileobj, SpooledTemporaryFile):
+        return fileobj._file  # pylint: disable=protected-access
+    return fileobj
+
+
+def _fileno(fileobj):
+    """Find the OS-level file descriptor backing a file-like object.
+
+    :param fileobj:
+        The file-like object to inspect.  A SpooledTemporaryFile that has not
+        yet rolled over to disk is treated as in-memory.
+
+    :returns:
+        The file descriptor, or None if the object is not backed by one.
+    """
+    fileobj = _backing_file(fileobj)
+    try:
+        return fileobj.fileno()
+    except (AttributeError, OSError):
+        return None
+
+
+def _copy_fileobj(src, dst):
+    """Copy the rest of one file-like object into another.
+
+    In-memory sources are written out in a single call through the buffer
+    protocol.  When both sides are backed by file descriptors, the copy is
+    done in-kernel with os.sendfile, unless the file system or platform
+    refuses it.  Anything else falls back to shutil.copyfileobj.
+
+    :param src:
+        The file-like object to read from, starting at its current position.
+
+    :param dst:
+        The file-like object to write to.
+    """
+    backing = _backing_file(src)
+    if hasattr(backing, 'getbuffer'):
+        with backing.getbuffer() as view, view[backing.tell():] as rest:
+            dst.write(rest)
+        backing.seek(0, 2)
+        return
+
+    src_fd = _fileno(src)
+    dst_fd = _fileno(dst)
+    if src_fd is None or dst_fd is None or not hasattr(os, 'sendfile'):
+        shutil.copyfileobj(src, dst, _COPY_BUFSIZE)
+        return
+
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    src.flush()
+    dst.flush()
+    start = offset = src.tell()
+    remaining = os.fstat(src_fd).st_size - offset
+    while remaining > 0:
+        try:
+            sent = os.sendfile(dst_fd, src_fd, offset, remaining)
+        except OSError as exc:
+            if offset != start or exc.errno not in _SENDFILE_UNSUPPORTED:
+                raise
+            # nothing has been sent yet, so just copy it the slow way.
+            src.seek(start)
+            shutil.copyfileobj(src, dst, _COPY_BUFSIZE)
+            return
+        if sent == 0:
+            break
+        offset += sent
+        remaining -= sent
+    src.seek(offset)
+    dst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+
+
+def _gzip_writer(fileobj, compresslevel):
+    """Open a gzip stream for writing into a file object.
+
+    This uses isa-l's igzip if it is installed, and the standard gzip module
+    otherwise.  isa-l only has levels 0-3, so the zlib level is scaled down to
+    1-3.  Level 0 is never used: unlike zlib, it does not fall back to stored
+    blocks and makes already-compressed files noticeably bigger.
+
+    :param fileobj:
+        The file-like object to write compressed data to.
+
+    :param int compresslevel:
+        The zlib-style compression level (1-9).
+
+    :returns:
+        A writable GzipFile.
+    """
+    if isal_zlib is not None:
+        compresslevel = min((compresslevel + 2) // 3,
+                            isal_zlib.ISAL_BEST_COMPRESSION)
+    return _gzip_mod.GzipFile(mode='wb', fileobj=fileobj,
+                              compresslevel=compresslevel, mtime=0)
+
+
+class _HashingWriter:
+    """A write-only file object that hashes everything written through it."""
+
+    def __init__(self, target, hasher):
+        """Wrap a file object.
+
+        :param target:
+            The file-like object to pass written data on to.
+
+        :param hasher:
+            The hashlib object to update with written data.
+        """
+        self.target = target
+        self.hasher = hasher
+
+    def write(self, data):
+        """Hash data, then write it to the target."""
+        self.hasher.update(data)
+        return self.target.write(data)
+
+    def flush(self):
+        """Flush the target."""
+        self.target.flush()
+
+
+class _PigzWriter:
+    """A write-only file object that compresses through a pigz subprocess.
+
+    pigz spreads compression across all available cores.  Its output is
+    pumped into the target file object from a background thread, so pigz
+    never stalls on a full pipe while we are still feeding it.
+    """
+
+    def __init__(self, pigz, fileobj, compresslevel):
+        """Start compressing.
+
+        :param str pigz:
+            The path to the pigz binary.
+
+        :param fileobj:
+            The file-like object to write compressed data to.
+
+        :param int compresslevel:
+            The gzip compression level (1-9).
+        """
+        self._proc = Popen([pigz, '-c', '-n', '-{0}'.format(compresslevel)],
+                           stdin=PIPE, stdout=PIPE, bufsize=_COPY_BUFSIZE)
+        self._offset = 0
+        self._error = None
+        self._pump = Thread(target=self._pump_output, args=(fileobj,))
+        self._pump.start()
+
+    def _pump_output(self, fileobj):
+        try:
+            shutil.copyfileobj(self._proc.stdout, fileobj, _COPY_BUFSIZE)
+        except Exception as exc:  # pylint: disable=broad-except
+            self._error = exc
+            # keep draining so pigz can finish and exit
+            while self._proc.stdout.read(_COPY_BUFSIZE):
+                pass
+
+    def write(self, data):
+        """Write uncompressed data."""
+        try:
+            written = self._proc.stdin.write(data)
+        except BrokenPipeError as exc:
+            # pigz died mid-stream; report why instead of the broken pipe.
+            raise self._exit_error(self._reap()) from exc
+        self._offset += written
+        return written
+
+    def tell(self):
+        """Return the number of uncompressed bytes written so far."""
+        return self._offset
+
+    def _reap(self):
+        """Close pigz's input, wait for it to exit and return its status."""
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            # pigz has already gone away; its exit status says why.
+            pass
+        self._pump.join()
+        self._proc.stdout.close()
+        return self._proc.wait()
+
+    @staticmethod
+    def _exit_error(code):
+        return OSError('pigz exited with status {code}'.format(code=code))
+
+    def close(self):
+        """Finish compressing and wait for pigz to exit."""
+        code = self._reap()
+        if code != 0:
+            raise self._exit_error(code)
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # don't let a failure here hide the exception already in flight.
+        try:
+            self.close()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.debug('pigz failed while unwinding', exc_info=True)
+
+
+def _data_compressor(fileobj, compresslevel):
+    """Open a gzip stream for data.tar.
+
+    pigz is used if it is installed; otherwise, this is :py:func:`_gzip_writer`
+    behind a large write buffer, so that the many small writes tarfile makes
+    reach the compressor in big batches.
+
+    :param fileobj:
+        The file-like object to write compressed data to.
+
+    :param int compresslevel:
+        The zlib-style compression level (1-9).
+
+    :returns:
+        A writable file-like object.
+    """
+    pigz = shutil.which('pigz')
+    if pigz is not None:
+        return _PigzWriter(pigz, fileobj, compresslevel)
+    return io.BufferedWriter(_gzip_writer(fileobj, compresslevel),
+                             _COPY_BUFSIZE)
+
+
+def _tar_header(name, size):
+    """Build the tar header for a regular file.
+
+    The control section only ever holds small files with short names, owned
+    by root with mode 0644 and no timestamp, so the ustar header is filled in
+    directly instead of going through TarInfo.  Anything that doesn't fit a
+    plain ustar header is left to TarInfo.
+
+    :param str name:
+        The name of the file inside the archive.
+
+    :param int size:
+        The size of the file.
+
+    :returns bytes:
+        The header block(s).
+    """
+    encoded = name.encode('ascii', 'replace')
+    if len(encoded) > 100 or encoded.decode('ascii') != name or\
+       size >= 8 ** 11:
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = size
+        return tarinfo.tobuf()
+
+    header = bytearray(tarfile.BLOCKSIZE)
+    header[0:len(encoded)] = encoded
+    header[100:108] = b'0000644\0'  # mode
+    header[108:116] = b'0000000\0'  # uid
+    header[116:124] = b'0000000\0'  # gid
+    header[124:136] = '{0:011o}\0'.format(size).encode('ascii')
+    header[136:148] = b'00000000000\0'  # mtime
+    header[148:156] = b'        '  # checksum, counted as spaces
+    header[156:157] = tarfile.REGTYPE
+    header[257:265] = tarfile.POSIX_MAGIC
+    header[148:155] = '{0:06o}\0'.format(sum(header)).encode('ascii')
+    return bytes(header)
+
+
+def _write_tar_member(fileobj, name, data):
+    """Write a regular file to a tar stream, without end-of-archive blocks.
+
+    :param fileobj:
+        The file-like object to write the tar stream to.
+
+    :param str name:
+        The name of the file inside the archive.
+
+    :param bytes data:
+        The contents of the file.
+    """
+    fileobj.write(_tar_header(name, len(data)))
+    fileobj.write(data)
+    fileobj.write(tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE))
+
+
+def _load_private_key(privkey):
+    """Load a PEM private key.
+
+    Parsed keys are cached, so signing many packages with the same key only
+    parses it once.  The cache is invalidated if the key file is modified.
 
     :param privkey:
         The path to the private key.
 
-    :param pubkey:
-        The public name of the public key (this will be included in the
-        signature, so it must match /etc/apk/keys/<name>).
-
     :returns:
-        A file-like object representing the signed control.tar.gz.
+        The private key object.
     """
-    signature = None
+    mtime = os.stat(privkey).st_mtime_ns
+    cached = _KEY_CACHE.get(privkey)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
 
     with open(privkey, "rb") as key_file:
         #password = getpass()
@@ -160,37 +730,71 @@ def _sign_control(control, privkey, pubkey):
         private_key = serialization.load_pem_private_key(
             key_file.read(), password=password, backend=default_backend()
         )
-        signer = private_key.signer(padding.PKCS1v15(), hashes.SHA256())
-        signer.update(control.getvalue())
-        signature = signer.finalize()
-        del signer
-        del private_key
 
-    iosignature = io.BytesIO(signature)
+    _KEY_CACHE[privkey] = (mtime, private_key)
+    return private_key
+
+
+def _sign_control(control, privkey, pubkey, compresslevel):
+    """Sign control.tar.
+
+    RSA keys produce a PKCS#1 v1.5 .SIGN.RSA. signature, which is what
+    apk-tools verifies.  Ed25519 and ECDSA keys are also accepted, and produce
+    .SIGN.ED25519. and .SIGN.ECDSA. signatures respectively; these are much
+    faster to make, but need a verifier that understands them.
+
+    :param control:
+        A file-like object representing the current control.tar.gz.
+
+    :param privkey:
+        The path to the private key.
 
-    new_control = io.BytesIO()
-    new_control_tar = tarfile.open(mode='w', fileobj=new_control)
-    tarinfo = tarfile.TarInfo('.SIGN.RSA.' + pubkey)
-    tarinfo.size = len(signature)
-    new_control_tar.addfile(tarinfo, fileobj=iosignature)
+    :param pubkey:
+        The public name of the public key (this will be included in the
+        signature, so it must match /etc/apk/keys/<name>).
 
-    new_control.seek(0)
-    controlgz = io.BytesIO()
-    with gzip.GzipFile(mode='wb', fileobj=controlgz) as gzobj:
-        shutil.copyfileobj(new_control, gzobj)
+    :param int compresslevel:
+        The gzip compression level (1-9).
 
+    :returns:
+        A file-like object representing the gzipped signature, which must be
+        placed in front of control.tar.gz.
+    """
+    private_key = _load_private_key(privkey)
     control.seek(0)
-    controlgz.seek(0, 2)
-    shutil.copyfileobj(control, controlgz)
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        # Ed25519 does its own hashing, so it has to see the whole message.
+        algorithm = 'ED25519'
+        signature = private_key.sign(control.read())
+    else:
+        # hash with hashlib and sign only the digest.
+        hasher = hashlib.sha256()
+        chunk = control.read(_HASH_BUFSIZE)
+        while chunk:
+            hasher.update(chunk)
+            chunk = control.read(_HASH_BUFSIZE)
+        prehashed = utils.Prehashed(hashes.SHA256())
+
+        if isinstance(private_key, ec.EllipticCurvePrivateKey):
+            algorithm = 'ECDSA'
+            signature = private_key.sign(hasher.digest(), ec.ECDSA(prehashed))
+        else:
+            algorithm = 'RSA'
+            signature = private_key.sign(hasher.digest(), padding.PKCS1v15(),
+                                         prehashed)
 
-    controlgz.seek(0)
+    signaturegz = SpooledTemporaryFile(max_size=_SPOOL_SIZE, mode='w+b')
+    with _gzip_writer(signaturegz, compresslevel) as gzobj:
+        _write_tar_member(gzobj, '.SIGN.{alg}.{key}'.format(alg=algorithm,
+                                                            key=pubkey),
+                          signature)
 
-    new_control_tar.close()
-    new_control.close()
-    return controlgz
+    signaturegz.seek(0)
+    return signaturegz
 
 
-def _make_data_tgz(datadir, mode, package, my_filter=None):
+def _make_data_tgz(datadir, mode, package, my_filter=None, hasher=None,
+                   compresslevel=6):
     """Make the data.tar.gz file.
 
     :param str datadir:
@@ -201,89 +805,98 @@ def _make_data_tgz(datadir, mode, package, my_filter=None):
 
     :param package:
         The Package object for this data.tar.gz file.  The 'size' parameter
-        will be set to the size of the data included.
+        will be set to the total size of the files included.
 
     :param callable my_filter:
-        A function passed to tarfile.add to filter contents.  Defaults to None.
-        If None, all files in datadir will be added.
+        A function called by :py:func:`_add_tree` with the TarInfo of each
+        entry under datadir.  It returns the TarInfo (possibly modified) to
+        include the entry, or None to leave it out; directories it rejects are
+        not descended into.  Defaults to None, which adds everything.
+
+    :param hasher:
+        A hashlib object to feed the compressed data.tar.gz through as it is
+        written.  Defaults to None (don't hash).
+
+    :param int compresslevel:
+        The gzip compression level (1-9).  Defaults to 6.
 
     :returns:
         A file-like object representing the data.tar.gz file.
     """
-    fd, pkg_data_path = mkstemp(prefix='apkkit-', suffix='.tar')
-    gzio = io.BytesIO()
+    gzio = SpooledTemporaryFile(max_size=_DATA_SPOOL_SIZE, mode='w+b')
+    sink = gzio if hasher is None else _HashingWriter(gzio, hasher)
 
     if my_filter is None:
         my_filter = lambda x: x
 
-    with os.fdopen(fd, 'xb') as fdfile:
-        with tarfile.open(mode=mode, fileobj=fdfile,
+    LOGGER.info('Creating and compressing data.tar...')
+    with _data_compressor(sink, compresslevel) as compressor:
+        with tarfile.open(mode=mode, fileobj=compressor,
                           format=tarfile.PAX_FORMAT) as data:
-            for item in glob.glob(datadir + '/*'):
-                data.add(item, arcname=os.path.basename(item), filter=my_filter)
-            members = [member for member in data.getmembers()
-                       if member.isfile()]
+            files, package.size = _add_tree(data, datadir, '', my_filter)
 
-        if len(members) == 0:
-            return None
-
-        fdfile.seek(0, 2)
-        package.size = fdfile.tell()
-        LOGGER.info('Hashing data.tar [pass 1]...')
-        fdfile.seek(0)
-        abuild_pipe = Popen(['abuild-tar', '--hash'], stdin=fdfile,
-                            stdout=PIPE)
-
-        LOGGER.info('Compressing data...')
-        with gzip.GzipFile(mode='wb', fileobj=gzio) as gzobj:
-            gzobj.write(abuild_pipe.communicate()[0])
+    if files == 0:
+        gzio.close()
+        return None
 
     return gzio
 
 
-def _make_control_tgz(package, mode):
+def _make_control_tgz(package, compresslevel=6):
     """Make the control.tar.gz file.
 
+    The .PKGINFO entry is written straight into the gzip stream, with no
+    end-of-archive blocks, since the data tar follows it.
+
     :param package:
         The :py:class:`~apkkit.base.package.Package` instance for the package.
 
-    :param str mode:
-        The mode to use for control.tar ('x' or 'w').
+    :param int compresslevel:
+        The gzip compression level (1-9).  Defaults to 6.
 
     :returns:
         A file-like object representing the control.tar.gz file.
     """
-    gzio = io.BytesIO()
-    control = io.BytesIO()
+    gzio = SpooledTemporaryFile(max_size=_SPOOL_SIZE, mode='w+b')
 
-    control_tar = tarfile.open(mode=mode, fileobj=control)
+    with _gzip_writer(gzio, compresslevel) as control_obj:
+        _write_tar_member(control_obj, '.PKGINFO',
+                          package.to_pkginfo().encode('utf-8'))
 
-    ioinfo = io.BytesIO(package.to_pkginfo().encode('utf-8'))
-    tarinfo = tarfile.TarInfo('.PKGINFO')
-    ioinfo.seek(0, 2)
-    tarinfo.size = ioinfo.tell()
-    ioinfo.seek(0)
+    gzio.seek(0)
+    return gzio
 
-    control_tar.addfile(tarinfo, fileobj=ioinfo)
 
-    control.seek(0)
-    with gzip.GzipFile(mode='wb', fileobj=gzio) as control_obj:
-        shutil.copyfileobj(control, control_obj)
+def _apk_path(out_path, package):
+    """Determine where to write the APK for a package.
 
-    control_tar.close()
+    :param str out_path:
+        The directory APKs are written to, or None to keep them in memory.
 
-    return gzio
+    :param package:
+        The :py:class:`~apkkit.base.package.Package` to name the file after.
+
+    :returns:
+        The path to write the APK to, or None.
+    """
+
+    if not out_path:
+        return None
+
+    return os.path.join(out_path, "{name}-{ver}.apk".format(
+        name=package.name, ver=package.version))
 
 
 class APKFile:
     """Represents an APK file on disk (or in memory)."""
 
     def __init__(self, filename=None, mode='r', fileobj=None, package=None):
+        self.filename = filename
+        self.fileobj = fileobj
         if filename is not None:
             self.tar = tarfile.open(filename, mode)
         elif fileobj is not None:
             self.tar = tarfile.open(mode=mode, fileobj=fileobj)
-            self.fileobj = fileobj
         else:
             raise ValueError("No filename or file object specified.")
 
@@ -294,53 +907,68 @@ class APKFile:
         else:
             self.package = package
 
-    @staticmethod
-    def _create_file(package, datadir, sign, signfile, data_hash, hash_method,
-                     mode, my_filter):
+    @classmethod
+    def _create_file(cls, package, datadir, sign, signfile, data_hash,
+                     hash_method, mode, my_filter, compresslevel, path=None):
         LOGGER.info('Creating data.tar...')
-        data_gzio = _make_data_tgz(datadir, mode, package, my_filter)
+        # the datahash is computed as data.tar.gz is written
+        hasher = hashlib.new(hash_method) if data_hash else None
+        data_gzio = _make_data_tgz(datadir, mode, package, my_filter, hasher,
+                                   compresslevel)
         if data_gzio is None:
             LOGGER.info('Empty package.  Nothing to write.')
             return None
 
-        # make the datahash
         if data_hash:
-            LOGGER.info('Hashing data.tar [pass 2]...')
-            data_gzio.seek(0)
-            hasher = getattr(hashlib, hash_method)(data_gzio.read())
             package.data_hash = hasher.hexdigest()
 
-        # if we made the hash, we need to seek back again
-        # if we didn't, we haven't seeked back yet
         data_gzio.seek(0)
 
-        # we are finished with fdfile (data.tar), now let's make control
+        # data.tar.gz is done, now let's make control
         LOGGER.info('Creating package header...')
-        controlgz = _make_control_tgz(package, mode)
+        controlgz = _make_control_tgz(package, compresslevel)
+        sections = [controlgz, data_gzio]
 
-        # we do NOT close control_tar yet, because we don't want the end of
-        # archive written out.
+        # the signature covers control.tar.gz exactly as written, so it is
+        # its own gzip member in front of it.
         if sign:
             LOGGER.info('Signing package...')
             signfile = os.getenv('PACKAGE_PRIVKEY', signfile)
             pubkey = os.getenv('PACKAGE_PUBKEY',
                                os.path.basename(signfile) + '.pub')
-            controlgz = _sign_control(controlgz, signfile, pubkey)
-
-        LOGGER.info('Creating package file (in memory)...')
-        combined = io.BytesIO()
-        shutil.copyfileobj(controlgz, combined)
-        shutil.copyfileobj(data_gzio, combined)
-
-        controlgz.close()
-        data_gzio.close()
-
-        return combined
+            sections.insert(0, _sign_control(controlgz, signfile, pubkey,
+                                             compresslevel))
+            controlgz.seek(0)
+
+        with ExitStack() as stack:
+            for section in sections:
+                stack.callback(section.close)
+
+            if path is None:
+                LOGGER.info('Creating package file (in memory)...')
+                combined = SpooledTemporaryFile(max_size=_SPOOL_SIZE,
+                                                mode='w+b')
+                for section in sections:
+                    _copy_fileobj(section, combined)
+                combined.seek(0)
+                return cls(fileobj=combined, package=package)
+
+            LOGGER.info('Writing APK to %s', path)
+            with open(path, 'xb', buffering=_COPY_BUFSIZE) as new_package:
+                try:
+                    for section in sections:
+                        _copy_fileobj(section, new_package)
+                except BaseException:
+                    # never leave a half-written APK behind.
+                    os.unlink(path)
+                    raise
+
+        return cls(filename=path, package=package)
 
 
     @classmethod
     def create(cls, package, datadir, sign=True, signfile=None, data_hash=True,
-               hash_method='sha256', **kwargs):
+               hash_method='sha256', compresslevel=6, **kwargs):
         """Create an APK file in memory from a package and data directory.
 
         :param package:
@@ -360,6 +988,18 @@ class APKFile:
 
         :param str hash_method:
             The hash method to use for hashing the data - default is sha256.
+
+        :param int compresslevel:
+            The gzip compression level (1-9) - default is 6.  If pigz or
+            isa-l is installed on the build host it is used instead of zlib,
+            so the bytes written, and therefore the datahash, depend on the
+            host.  isa-l is much faster but compresses worse: 1-3, 4-6 and
+            7-9 map to its levels 1, 2 and 3, and at the default that makes
+            packages roughly 10% bigger than zlib's level 6.
+
+        :param str out_path:
+            If set, each APK is written straight into this directory as
+            <name>-<version>.apk, instead of being built in memory.
         """
 
         LOGGER.info('Creating APK from data in: %s', datadir)
@@ -373,6 +1013,7 @@ class APKFile:
             mode = 'w'
 
         files = []
+        out_path = kwargs.pop('out_path', None)
 
         if package.name in skip_split():
             splits = []
@@ -400,42 +1041,44 @@ class APKFile:
             else:
                 split_package._provides = []
 
+            paths = []
             file_matches = []
             for path in split['paths']:
                 if '*' in path:
-                    file_matches += [str(f.relative_to(datadir))
-                                     for f in Path(datadir).glob(path)]
-                    split['paths'].remove(path)
+                    file_matches.extend(str(f.relative_to(datadir))
+                                        for f in Path(datadir).glob(path))
+                else:
+                    paths.append(path)
 
-            split['paths'] += file_matches
+            split['paths'] = paths + file_matches
 
             LOGGER.info('Probing for split package: %s', split_package.name)
-            combined = APKFile._create_file(split_package, datadir, sign,
-                                            signfile, data_hash, hash_method,
-                                            mode, partial(split_filter, split))
-            if combined:
-                files.append(cls(fileobj=combined, package=split_package))
+            apk_file = cls._create_file(split_package, datadir, sign,
+                                        signfile, data_hash, hash_method, mode,
+                                        _compile_split_filter(split),
+                                        compresslevel,
+                                        _apk_path(out_path, split_package))
+            if apk_file:
+                files.append(apk_file)
 
-            exclude_from_base += [path for path in split['paths']]
+            exclude_from_base.extend(split['paths'])
 
         LOGGER.info('Processing main package: %s', package.name)
-        combined = APKFile._create_file(package, datadir, sign, signfile,
-                                        data_hash, hash_method, mode,
-                                        partial(base_filter, exclude_from_base))
-        if combined:
-            files.append(cls(fileobj=combined, package=package))
-
-        out_path = kwargs.pop('out_path', None)
-        if out_path:
-            for apk_file in files:
-                name = "{name}-{ver}.apk".format(name=apk_file.package.name,
-                                                 ver=apk_file.package.version)
-                apk_file.write(os.path.join(out_path, name))
+        apk_file = cls._create_file(package, datadir, sign, signfile,
+                                    data_hash, hash_method, mode,
+                                    _compile_base_filter(exclude_from_base),
+                                    compresslevel, _apk_path(out_path, package))
+        if apk_file:
+            files.append(apk_file)
 
     def write(self, path):
         """Write the APK currently loaded to a file at path."""
 
         LOGGER.info('Writing APK to %s', path)
-        self.fileobj.seek(0)
         with open(path, 'xb') as new_package:
-            shutil.copyfileobj(self.fileobj, new_package)
+            if self.fileobj is None:
+                with open(self.filename, 'rb') as package:
+                    _copy_fileobj(package, new_package)
+            else:
+                self.fileobj.seek(0)
+                _copy_fileobj(self.fileobj, new_package)
@@ -92,6 +92,7 @@ import logging
 import os
 import sys
 
+from functools import lru_cache
 from itertools import filterfalse
 import portage
 from portage.dep import Atom, use_reduce
@@ -189,6 +190,22 @@ def _deps_need_an_adult(name, pvr, eapi='6'):
         raise exc
 
 
+@lru_cache(maxsize=256)
+def _vardb_match_slots(dep):
+    """Find the slots of installed packages matching a dependency.
+
+    Results are cached, since the same atom tends to appear many times.
+
+    :param dep:
+        The Atom to match against the installed package database.
+
+    :returns frozenset:
+        The slots of all matching installed packages.
+    """
+
+    return frozenset(pot.slot for pot in VARDB.match(dep))
+
+
 def _translate_dep(dep):
     category, package = dep.cp.split('/', 1)
 
@@ -200,15 +217,14 @@ def _translate_dep(dep):
         if dep.slot != "0":
             package += dep.slot
     elif package != 'ncurses':  # so especially broken it's special cased
-        potentials = VARDB.match(dep)
-        potential_slots = set([pot.slot for pot in potentials])
+        potential_slots = _vardb_match_slots(dep)
         if len(potential_slots) > 1:
             msg = 'Dependency for {name} has multiple candidate slots,'
             msg += ' and no single slot can be resolved.'
             _fatal(msg.format(name=dep))
             sys.exit(-1)
         elif len(potential_slots) == 1:
-            slot = potential_slots.pop()
+            slot = next(iter(potential_slots))
             if slot and slot != '0':
                 package += slot
         else:
@@ -293,15 +309,16 @@ def native(settings, mydbapi=None):
         _fatal('CPV does not exist or DBAPI is missing')
         sys.exit(-1)
 
-    desc, url = mydbapi.aux_get(cpv, ('DESCRIPTION', 'HOMEPAGE'))
+    desc, url, rdepend = mydbapi.aux_get(cpv, ('DESCRIPTION', 'HOMEPAGE',
+                                               'RDEPEND'))
     params['description'] = desc
     params['url'] = url
 
-    run_deps = use_reduce(mydbapi.aux_get(cpv, ('RDEPEND',)),
+    run_deps = use_reduce(rdepend,
                           uselist=settings['USE'], opconvert=True,
                           token_class=Atom, eapi=settings['EAPI'])
 
-    if any([isinstance(dep, list) for dep in run_deps]):
+    if any(isinstance(dep, list) for dep in run_deps):
         run_deps = _deps_need_an_adult(params['name'], settings['PVR'],
                                        settings['EAPI'])
 